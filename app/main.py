@@ -6,19 +6,37 @@ import urllib.parse
 from pathlib import Path 
 from typing import Union, List, Dict, Any
 import asyncio 
+import anyio
+import collections
 import concurrent.futures
+import contextvars
+import gzip
+import hashlib
+import math
+import mimetypes
+import os
+import random
+import tempfile
+import threading
 from fastapi import FastAPI, Response, Request, Cookie, Form 
 from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from starlette.concurrency import run_in_threadpool 
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates")) 
+templates.env.auto_reload = False
 
 class APITimeoutError(Exception): pass
 
+class UpstreamSaturatedError(APITimeoutError): pass
+
 def getRandomUserAgent(): 
     return {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/94.0.4606.61 Safari/537.36'}
 
@@ -35,6 +53,45 @@ failed = "Load Failed"
 MAX_RETRIES = 10   
 RETRY_DELAY = 5.0 
 
+PLAYLIST_CACHE_TTL = 600.0
+PLAYLIST_CACHE_MAX_ENTRIES = 128
+PLAYLIST_PAGE_CONCURRENCY = 6
+PLAYLIST_MAX_PAGES = 50
+PLAYLIST_READ_AHEAD = 2
+
+REQUEST_DEADLINE = 20.0
+UPSTREAM_QUEUE_TIMEOUT = 2.0
+UPSTREAM_MAX_QUEUE = 64
+RETRY_AFTER_SECONDS = 5
+UPSTREAM_CANCEL_POLL_INTERVAL = 0.1
+EDU_KEY_REFRESH_INTERVAL = 600.0
+EDU_KEY_RETRY_MIN = 5.0
+EDU_KEY_RETRY_MAX = 300.0
+EDU_KEY_SHARED_CACHE = Path(tempfile.gettempdir()) / "yuzutube_edu_key.json"
+
+COMPRESSION_MINIMUM_SIZE = 1024
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STATIC_REVALIDATE_CACHE_CONTROL = "public, no-cache"
+COMPRESSIBLE_MEDIA_TYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+UPSTREAM_LIMITS = {
+    'invidious': 64,
+    'invidious_prefetch': 16,
+    'edu': 16,
+    'stream': 16,
+    'bbs': 8,
+    'thumbnail': 32,
+    'suggest': 8,
+    'edu_key': 2,
+}
+
 EDU_STREAM_API_BASE_URL = "https://siawaseok.duckdns.org/api/stream/" 
 EDU_VIDEO_API_BASE_URL = "https://siawaseok.duckdns.org/api/video2/"
 STREAM_YTDL_API_BASE_URL = "https://yudlp.vercel.app/stream/" 
@@ -87,23 +144,232 @@ class InvidiousAPI:
         self.comments = list(self.all['comments'])
         self.check_video = False
 
+class RequestBudget:
+    def __init__(self, timeout=REQUEST_DEADLINE):
+        self.deadline = time.monotonic() + timeout
+        self.cancelled = threading.Event()
+        self.shed = False
+
+    def remaining(self):
+        if self.cancelled.is_set():
+            return 0.0
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self, timeout=max_api_wait_time):
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise APITimeoutError("Request deadline exceeded or client disconnected.")
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+request_budget = contextvars.ContextVar("request_budget", default=None)
+
+def getRequestBudget():
+    budget = request_budget.get()
+    return budget if budget is not None else RequestBudget()
+
+class UpstreamLimiter:
+    def __init__(self, limit, max_queue=UPSTREAM_MAX_QUEUE):
+        # limit は同時に開けてよい上流ソケット数
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = collections.deque()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _wake(self):
+        while self._waiters:
+            weight, future = self._waiters[0]
+            if future.done():
+                self._waiters.popleft()
+                continue
+            if self.active + weight > self.limit:
+                break
+            self._waiters.popleft()
+            self.active += weight
+            future.set_result(None)
+
+    def _abandon(self, waiter):
+        weight, future = waiter
+        if future.done() and not future.cancelled():
+            self.release(weight)
+            return
+        future.cancel()
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        self._wake()
+
+    async def acquire(self, budget, weight=1):
+        remaining = budget.remaining()
+        if remaining <= 0:
+            raise APITimeoutError("Request deadline exceeded or client disconnected.")
+        if not self._waiters and self.active + weight <= self.limit:
+            self.active += weight
+            return
+        if len(self._waiters) >= self.max_queue:
+            raise UpstreamSaturatedError("Upstream queue is full.")
+
+        waiter = (weight, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait({waiter[1]}, timeout=min(UPSTREAM_QUEUE_TIMEOUT, remaining))
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+        if not waiter[1].done():
+            self._abandon(waiter)
+            raise UpstreamSaturatedError("Timed out waiting for an upstream slot.")
+
+    def release(self, weight=1):
+        self.active -= weight
+        self._wake()
+
+class UpstreamLease:
+    def __init__(self, limiter, weight):
+        self.limiter = limiter
+        self.loop = asyncio.get_running_loop()
+        self.held = weight
+        self.retained = 0
+        self.lock = threading.Lock()
+
+    def _release(self, weight):
+        if weight <= 0:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.limiter.release, weight)
+        except RuntimeError:
+            pass
+
+    def retain(self):
+        # 呼び出しが戻った後も開いたままになるソケットは、閉じた時点で個別に返す
+        with self.lock:
+            self.retained += 1
+
+    def releaseRetained(self):
+        with self.lock:
+            self.retained -= 1
+            self.held -= 1
+        self._release(1)
+
+    def close(self):
+        with self.lock:
+            weight = self.held - self.retained
+            self.held -= weight
+        self._release(weight)
+
+upstream_limiters = {kind: UpstreamLimiter(limit) for kind, limit in UPSTREAM_LIMITS.items()}
+upstream_lease = contextvars.ContextVar("upstream_lease", default=None)
+_upstream_thread_limiter = None
+
+def getUpstreamThreadLimiter():
+    # どの呼び出しも最低 1 ソケット分の枠を取るので、ソケット予算の合計だけスレッドがあれば
+    # anyio 既定のスレッド上限 (40) の手前で待たされることはない
+    global _upstream_thread_limiter
+    if _upstream_thread_limiter is None:
+        _upstream_thread_limiter = anyio.CapacityLimiter(sum(UPSTREAM_LIMITS.values()))
+    return _upstream_thread_limiter
+
+async def runUpstream(kind, func, *args, sockets=1):
+    budget = getRequestBudget()
+    limiter = upstream_limiters[kind]
+    weight = max(1, min(sockets, limiter.limit))
+    try:
+        await limiter.acquire(budget, weight)
+    except UpstreamSaturatedError:
+        budget.shed = True
+        raise
+    lease = UpstreamLease(limiter, weight)
+
+    def call():
+        budget_token = request_budget.set(budget)
+        lease_token = upstream_lease.set(lease)
+        try:
+            return func(*args)
+        finally:
+            upstream_lease.reset(lease_token)
+            request_budget.reset(budget_token)
+
+    def done(task):
+        lease.close()
+        if not task.cancelled():
+            task.exception()
+
+    task = asyncio.ensure_future(anyio.to_thread.run_sync(call, limiter=getUpstreamThreadLimiter()))
+    task.add_done_callback(done)
+    return await asyncio.shield(task)
+
+async def requestInvidious(path, api_urls, kind="invidious"):
+    return await runUpstream(kind, requestAPI, path, api_urls, sockets=len(api_urls))
+
+def submitUpstream(executor, func, *args, **kwargs):
+    # 呼び出しが戻った後も開いたままの接続は、閉じた時点で枠を返す
+    lease = upstream_lease.get()
+    future = executor.submit(func, *args, **kwargs)
+    if lease is not None:
+        lease.retain()
+        future.add_done_callback(lambda f: lease.releaseRetained())
+    return future
+
+def waitUpstream(pending, budget, deadline):
+    # 完了した future を順に返し、切断か期限切れで打ち切る
+    while pending and not budget.cancelled.is_set():
+        wait_time = deadline - time.monotonic()
+        if wait_time <= 0:
+            return
+        done, pending = concurrent.futures.wait(
+            pending, 
+            timeout=min(wait_time, UPSTREAM_CANCEL_POLL_INTERVAL), 
+            return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        yield from done
+
+def requestUpstream(func, url, timeout=max_api_wait_time, **kwargs):
+    budget = getRequestBudget()
+    total = sum(timeout) if isinstance(timeout, tuple) else timeout
+    deadline = time.monotonic() + budget.timeout(total)
+
+    # (connect, read) のタイムアウトは読み取り毎なので、全体の期限はここで打ち切る
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    try:
+        future = submitUpstream(executor, func, url, timeout=budget.timeout(timeout), **kwargs)
+        for future in waitUpstream({future}, budget, deadline):
+            return future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    raise requests.exceptions.Timeout(f"Request to {url} was cancelled or exceeded the request deadline.")
+
 def requestAPI(path, api_urls):
     apis_to_try = api_urls
     
     if not apis_to_try:
         raise APITimeoutError("No API instances configured for this type of request.")
         
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(apis_to_try)) as executor:
-        future_to_api = {
-            executor.submit(
+    budget = getRequestBudget()
+    api_wait_time = budget.timeout(max_api_wait_time)
+    deadline = time.monotonic() + budget.timeout(max_time)
+        
+    # 結果が出るか切断されたらすぐ戻る。残りの接続はそれぞれのタイムアウトで閉じる
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(apis_to_try))
+    try:
+        pending = {
+            submitUpstream(
+                executor, 
                 requests.get, 
                 api + 'api/v1' + path, 
                 headers=getRandomUserAgent(), 
-                timeout=max_api_wait_time
-            ): api for api in apis_to_try
+                timeout=api_wait_time
+            ) for api in apis_to_try
         }
         
-        for future in concurrent.futures.as_completed(future_to_api, timeout=max_time):
+        for future in waitUpstream(pending, budget, deadline):
             try:
                 res = future.result()
                 
@@ -112,27 +378,143 @@ def requestAPI(path, api_urls):
                 
             except requests.exceptions.RequestException:
                 continue
-            except concurrent.futures.TimeoutError:
-                break
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
             
     raise APITimeoutError("All available API instances failed to respond or timed out.")
 
 def getEduKey():
     api_url = "https://apis.kahoot.it/media-api/youtube/key"
-    try:
-        res = requests.get(api_url, headers=getRandomUserAgent(), timeout=max_api_wait_time)
-        res.raise_for_status() 
-        
-        if isJSON(res.text):
-            data = json.loads(res.text)
-            return data.get("key")
-        
-    except requests.exceptions.RequestException:
-        pass
-    except json.JSONDecodeError:
-        pass
+    res = requestUpstream(requests.get, api_url, headers=getRandomUserAgent())
+    res.raise_for_status() 
     
-    return None
+    key = res.json().get("key")
+    if not key:
+        raise ValueError("Kahoot API response is missing the 'key' field.")
+    return key
+
+class EduKeyProvider:
+    def __init__(self, cache_path=EDU_KEY_SHARED_CACHE, refresh_interval=EDU_KEY_REFRESH_INTERVAL):
+        self.cache_path = Path(cache_path)
+        self.refresh_interval = refresh_interval
+        self.key = None
+        self.fetched_at = None
+        self.refresh_failures = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.retry_at = None
+        self._task = None
+        self._refreshing = None
+
+    def age(self):
+        if self.fetched_at is None:
+            return None
+        return max(0.0, time.time() - self.fetched_at)
+
+    def loadShared(self):
+        # 他のワーカーが取得したキーの方が新しければそれを使う
+        try:
+            data = json.loads(self.cache_path.read_text())
+        except (OSError, ValueError):
+            return False
+        if not data.get("key") or not isinstance(data.get("fetched_at"), (int, float)):
+            return False
+        if self.fetched_at is None or data["fetched_at"] > self.fetched_at:
+            self.key = data["key"]
+            self.fetched_at = data["fetched_at"]
+        return True
+
+    def saveShared(self):
+        tmp_path = self.cache_path.with_name(f"{self.cache_path.name}.{os.getpid()}.tmp")
+        try:
+            tmp_path.write_text(json.dumps({"key": self.key, "fetched_at": self.fetched_at}))
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            pass
+
+    async def refresh(self):
+        # バックグラウンド更新とキー未取得時のリクエストで同じ取得を共有する
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refreshDone)
+        return await asyncio.shield(self._refreshing)
+
+    def _refreshDone(self, task):
+        self._refreshing = None
+        if not task.cancelled():
+            task.exception()
+
+    async def getKey(self):
+        if self.key is None:
+            # 取得に失敗した後はバックオフが明けるまで上流に問い合わせない
+            if self._refreshing is not None or self.retry_at is None or time.monotonic() >= self.retry_at:
+                await self.refresh()
+            else:
+                self.loadShared()
+        return self.key
+
+    async def _refresh(self):
+        request_budget.set(RequestBudget())
+        self.loadShared()
+        if self.key and self.age() < self.refresh_interval:
+            return True
+
+        try:
+            key = await runUpstream("edu_key", getEduKey)
+        except Exception as e:
+            self.refresh_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            self.retry_at = time.monotonic() + self.nextDelay(False)
+            return False
+
+        self.key = key
+        self.fetched_at = time.time()
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.retry_at = None
+        self.saveShared()
+        return True
+
+    def nextDelay(self, ok):
+        if ok:
+            delay = max(EDU_KEY_RETRY_MIN, self.refresh_interval - (self.age() or 0.0))
+        else:
+            delay = min(EDU_KEY_RETRY_MAX, EDU_KEY_RETRY_MIN * 2 ** (self.consecutive_failures - 1))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def run(self):
+        while True:
+            # 失敗後の再試行時刻はリクエスト側の取得と共有する
+            if self.retry_at is not None and self.retry_at > time.monotonic():
+                await asyncio.sleep(self.retry_at - time.monotonic())
+                continue
+            if await self.refresh():
+                await asyncio.sleep(self.nextDelay(True))
+
+    def start(self):
+        self.loadShared()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        age = self.age()
+        return {
+            "available": self.key is not None,
+            "age_seconds": round(age, 1) if age is not None else None,
+            "refresh_failures": self.refresh_failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error
+        }
 
 
 def formatSearchData(data_dict, failed="Load Failed"):
@@ -171,10 +553,10 @@ def formatSearchData(data_dict, failed="Load Failed"):
 def fetch_video_data_from_edu_api(videoid: str):
     target_url = f"{EDU_VIDEO_API_BASE_URL}{urllib.parse.quote(videoid)}"
     
-    res = requests.get(
+    res = requestUpstream(
+        requests.get, 
         target_url, 
-        headers=getRandomUserAgent(), 
-        timeout=max_api_wait_time
+        headers=getRandomUserAgent()
     )
     res.raise_for_status()
     return res.json()
@@ -209,7 +591,7 @@ def format_related_video(related_data: dict) -> dict:
 
 async def getVideoData(videoid):
     try:
-        t = await run_in_threadpool(fetch_video_data_from_edu_api, videoid)
+        t = await runUpstream("edu", fetch_video_data_from_edu_api, videoid)
     except requests.exceptions.RequestException as e:
         raise APITimeoutError(f"New video API failed: {e}") from e
     except json.JSONDecodeError as e:
@@ -236,20 +618,20 @@ async def getVideoData(videoid):
     return [video_details, recommended_videos]
     
 async def getSearchData(q, page):
-    datas_text = await run_in_threadpool(requestAPI, f"/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", invidious_api.search)
+    datas_text = await requestInvidious(f"/search?q={urllib.parse.quote(q)}&page={page}&hl=jp", invidious_api.search)
     datas_dict = json.loads(datas_text)
     return [formatSearchData(data_dict) for data_dict in datas_dict]
 
 async def getTrendingData(region: str):
     path = f"/trending?region={region}&hl=jp"
-    datas_text = await run_in_threadpool(requestAPI, path, invidious_api.search)
+    datas_text = await requestInvidious(path, invidious_api.search)
     datas_dict = json.loads(datas_text)
     return [formatSearchData(data_dict) for data_dict in datas_dict if data_dict.get("type") == "video"]
 
 async def getChannelData(channelid):
     t = {}
     try:
-        t_text = await run_in_threadpool(requestAPI, f"/channels/{urllib.parse.quote(channelid)}", invidious_api.channel)
+        t_text = await requestInvidious(f"/channels/{urllib.parse.quote(channelid)}", invidious_api.channel)
         t = json.loads(t_text)
 
         latest_videos_check = t.get('latestVideos') or t.get('latestvideo')
@@ -289,13 +671,141 @@ async def getChannelData(channelid):
         "tags": t.get("tags", [])
     }]
 
+class PlaylistIndex:
+    def __init__(self, max_entries=PLAYLIST_CACHE_MAX_ENTRIES, ttl=PLAYLIST_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.pending = {}
+
+    def get(self, listid):
+        entry = self.entries.get(listid)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["created"] > self.ttl:
+            self.entries.pop(listid, None)
+            return None
+        self.entries.move_to_end(listid)
+        return entry
+
+    def put(self, listid, entry):
+        self.entries[listid] = entry
+        self.entries.move_to_end(listid)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+def compactPlaylistVideos(videos):
+    # 1行 = (title, videoId, authorId, author) のタプルでキャッシュを小さく保つ
+    return tuple((i["title"], i["videoId"], i["authorId"], i["author"]) for i in videos)
+
+def expandPlaylistVideos(rows):
+    return [{"title": title, "id": videoid, "authorId": authorid, "author": author, "type": "video"} for title, videoid, authorid, author in rows]
+
+async def fetchPlaylistPage(listid, page, kind="invidious"):
+    t_text = await requestInvidious(f"/playlists/{urllib.parse.quote(listid)}?page={urllib.parse.quote(str(page))}", invidious_api.playlist, kind)
+    return json.loads(t_text)
+
+async def buildPlaylistIndex(listid):
+    # 同じリストへの同時アクセスで共有されるので、呼び出し元とは別の期限で動かす
+    request_budget.set(RequestBudget())
+    try:
+        t = await fetchPlaylistPage(listid, 1)
+        videos = t["videos"]
+        video_count = max(int(t.get("videoCount") or 0), len(videos))
+        page_count = 1
+        if videos:
+            page_count = max(1, math.ceil(video_count / len(videos)))
+
+        entry = {
+            "created": time.monotonic(),
+            "video_count": video_count,
+            "page_count": page_count,
+            "pages": {1: compactPlaylistVideos(videos)},
+            "tasks": {},
+            "semaphore": asyncio.Semaphore(PLAYLIST_PAGE_CONCURRENCY)
+        }
+        playlist_index.put(listid, entry)
+        return entry
+    finally:
+        playlist_index.pending.pop(listid, None)
+
+async def getPlaylistIndex(listid):
+    entry = playlist_index.get(listid)
+    if entry is not None:
+        return entry
+
+    task = playlist_index.pending.get(listid)
+    if task is None:
+        task = asyncio.ensure_future(buildPlaylistIndex(listid))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        playlist_index.pending[listid] = task
+    return await asyncio.shield(task)
+
+def loadPlaylistPages(listid, entry, pages, kind="invidious"):
+    async def load(page):
+        # 先読みは呼び出し元のリクエストが終わっても続くので、専用の期限で動かす
+        request_budget.set(RequestBudget())
+        async with entry["semaphore"]:
+            try:
+                t = await fetchPlaylistPage(listid, page, kind)
+                entry["pages"][page] = compactPlaylistVideos(t["videos"])
+            except (APITimeoutError, json.JSONDecodeError, KeyError):
+                pass
+            finally:
+                entry["tasks"].pop(page, None)
+
+    tasks = []
+    for page in pages:
+        if page in entry["pages"]:
+            continue
+        task_kind, task = entry["tasks"].get(page, (kind, None))
+        if task is None:
+            task = asyncio.ensure_future(load(page))
+            entry["tasks"][page] = (kind, task)
+        tasks.append((task_kind, task))
+    return tasks
+
 async def getPlaylistData(listid, page):
-    t_text = await run_in_threadpool(requestAPI, f"/playlists/{urllib.parse.quote(listid)}?page={urllib.parse.quote(str(page))}", invidious_api.playlist)
-    t = json.loads(t_text)["videos"]
-    return [{"title": i["title"], "id": i["videoId"], "authorId": i["authorId"], "author": i["author"], "type": "video"} for i in t]
+    entry = await getPlaylistIndex(listid)
+    page_count = entry["page_count"]
+
+    if str(page) == "all":
+        # 一度に組み立てるのは先頭 PLAYLIST_MAX_PAGES ページまで
+        pages = range(1, min(page_count, PLAYLIST_MAX_PAGES) + 1)
+        tasks = [task for _, task in loadPlaylistPages(listid, entry, pages)]
+        if tasks:
+            # 読み込みタスクは他のリクエストと共有しているので、切断時にも巻き込んでキャンセルしない
+            await asyncio.wait(tasks)
+        missing = [n for n in pages if n not in entry["pages"]]
+        if missing:
+            raise APITimeoutError(f"Failed to load pages {missing} of playlist {listid}.")
+        videos = []
+        for n in pages:
+            videos.extend(expandPlaylistVideos(entry["pages"][n]))
+        return [videos, page_count]
+
+    page = int(page)
+    if page < 1 or page > page_count:
+        return [[], page_count]
+
+    if page not in entry["pages"]:
+        task_kind, task = loadPlaylistPages(listid, entry, [page])[0]
+        await asyncio.shield(task)
+        if page not in entry["pages"] and task_kind != "invidious":
+            # 先読み用の枠で落とされたページは、通常の枠で取り直す
+            task_kind, task = loadPlaylistPages(listid, entry, [page])[0]
+            await asyncio.shield(task)
+        if page not in entry["pages"]:
+            raise APITimeoutError(f"Failed to load page {page} of playlist {listid}.")
+
+    # 次のページ遷移をキャッシュヒットにするため、数ページだけ低優先度の枠で先読みする
+    read_ahead_end = min(page_count, page + PLAYLIST_READ_AHEAD)
+    loadPlaylistPages(listid, entry, range(page + 1, read_ahead_end + 1), kind="invidious_prefetch")
+
+    return [expandPlaylistVideos(entry["pages"][page]), page_count]
 
 async def getCommentsData(videoid):
-    t_text = await run_in_threadpool(requestAPI, f"/comments/{urllib.parse.quote(videoid)}", invidious_api.comments)
+    t_text = await requestInvidious(f"/comments/{urllib.parse.quote(videoid)}", invidious_api.comments)
     t = json.loads(t_text)["comments"]
     return [{"author": i["author"], "authoricon": i["authorThumbnails"][-1]["url"], "authorid": i["authorId"], "body": i["contentHtml"].replace("\n", "<br>")} for i in t]
 
@@ -303,10 +813,10 @@ async def getCommentsData(videoid):
 def get_ytdl_formats(videoid: str) -> List[Dict[str, Any]]:
     target_url = f"{STREAM_YTDL_API_BASE_URL}{videoid}"
     
-    res = requests.get(
+    res = requestUpstream(
+        requests.get, 
         target_url, 
-        headers=getRandomUserAgent(), 
-        timeout=max_api_wait_time
+        headers=getRandomUserAgent()
     )
     res.raise_for_status()
     data = res.json()
@@ -340,7 +850,7 @@ def fetch_high_quality_streams(videoid: str) -> Dict[str, str]:
     API_URL = f"https://yudlp.vercel.app/m3u8/{videoid}"
 
     try:
-        response = requests.get(API_URL, timeout=15) 
+        response = requestUpstream(requests.get, API_URL, timeout=15) 
         response.raise_for_status() 
         data = response.json()
         
@@ -389,10 +899,10 @@ async def fetch_embed_url_from_external_api(videoid: str) -> str:
     target_url = f"{EDU_STREAM_API_BASE_URL}{videoid}"
     
     def sync_fetch():
-        res = requests.get(
+        res = requestUpstream(
+            requests.get, 
             target_url, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time
+            headers=getRandomUserAgent()
         )
         res.raise_for_status()
         data = res.json()
@@ -403,35 +913,35 @@ async def fetch_embed_url_from_external_api(videoid: str) -> str:
             
         return embed_url
 
-    return await run_in_threadpool(sync_fetch)
+    return await runUpstream("edu", sync_fetch)
 
 async def fetch_short_data_from_external_api(channelid: str) -> Dict[str, Any]:
     target_url = f"{SHORT_STREAM_API_BASE_URL}{urllib.parse.quote(channelid)}"
     
     def sync_fetch():
-        res = requests.get(
+        res = requestUpstream(
+            requests.get, 
             target_url, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time 
+            headers=getRandomUserAgent()
         )
         res.raise_for_status()
         return res.json()
 
-    return await run_in_threadpool(sync_fetch)
+    return await runUpstream("stream", sync_fetch)
 
 async def fetch_bbs_posts():
     target_url = f"{BBS_EXTERNAL_API_BASE_URL}/posts"
     
     def sync_fetch():
-        res = requests.get(
+        res = requestUpstream(
+            requests.get, 
             target_url, 
-            headers=getRandomUserAgent(), 
-            timeout=max_api_wait_time
+            headers=getRandomUserAgent()
         )
         res.raise_for_status()
         return res.json()
 
-    return await run_in_threadpool(sync_fetch)
+    return await runUpstream("bbs", sync_fetch)
 
 async def post_new_message(client_ip: str, name: str, body: str):
     target_url = f"{BBS_EXTERNAL_API_BASE_URL}/post"
@@ -442,40 +952,272 @@ async def post_new_message(client_ip: str, name: str, body: str):
             "X-Original-Client-IP": client_ip
         }
         
-        res = requests.post(
+        res = requestUpstream(
+            requests.post, 
             target_url, 
             json={"name": name, "body": body},
-            headers=headers,
-            timeout=max_api_wait_time
+            headers=headers
         )
         res.raise_for_status()
         return res.json()
 
-    return await run_in_threadpool(sync_post)
+    return await runUpstream("bbs", sync_post)
+
+def chooseEncoding(accept_encoding, available=("br", "gzip")):
+    accepted = set()
+    for token in accept_encoding.split(","):
+        name, _, params = token.partition(";")
+        params = params.strip()
+        quality = 1.0
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            accepted.add(name.strip().lower())
+    for encoding in available:
+        if encoding == "br" and brotli is None:
+            continue
+        if encoding in accepted:
+            return encoding
+    return None
+
+def compressBody(body, encoding, level=6):
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=min(level, 9), mtime=0)
+
+def isCompressible(content_type):
+    return content_type.split(";")[0].strip().lower() in COMPRESSIBLE_MEDIA_TYPES
+
+class StaticAssets:
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.assets = {}
+        self.urls = {}
+        for file in sorted(self.directory.rglob("*")):
+            if file.is_file():
+                self.add(file)
+
+    def add(self, file):
+        path = file.relative_to(self.directory).as_posix()
+        content = file.read_bytes()
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        stem, dot, suffix = path.rpartition(".")
+        hashed_path = f"{stem}.{digest}.{suffix}" if dot else f"{path}.{digest}"
+        media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+        # 起動時に最高圧縮率で作っておき、リクエスト毎には圧縮しない
+        variants = {"identity": content}
+        if isCompressible(media_type):
+            for encoding in ("br", "gzip"):
+                if encoding == "br" and brotli is None:
+                    continue
+                compressed = compressBody(content, encoding, level=11)
+                if len(compressed) < len(content):
+                    variants[encoding] = compressed
+
+        asset = {"media_type": media_type, "digest": digest, "variants": variants}
+        self.assets[path] = {**asset, "cache_control": STATIC_REVALIDATE_CACHE_CONTROL}
+        self.assets[hashed_path] = {**asset, "cache_control": STATIC_CACHE_CONTROL}
+        self.urls[path] = f"/static/{hashed_path}"
+
+    def url(self, path):
+        return self.urls.get(path, f"/static/{path}")
+
+    async def __call__(self, scope, receive, send):
+        request_headers = Headers(scope=scope)
+        path, root_path = scope["path"], scope.get("root_path", "")
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        asset = self.assets.get(path.lstrip("/"))
+
+        if scope["method"] not in ("GET", "HEAD"):
+            response = Response(status_code=405, headers={"Allow": "GET, HEAD"})
+        elif asset is None:
+            response = Response("Not Found", status_code=404)
+        else:
+            encoding = chooseEncoding(request_headers.get("accept-encoding", ""), available=[e for e in ("br", "gzip") if e in asset["variants"]])
+            # 強い ETag は表現ごとに一意にする必要があるので、圧縮形式ごとに変える
+            etag = f'"{asset["digest"]}-{encoding}"' if encoding else f'"{asset["digest"]}"'
+            headers = {
+                "Cache-Control": asset["cache_control"],
+                "ETag": etag,
+                "Vary": "Accept-Encoding"
+            }
+            if_none_match = [tag.strip() for tag in request_headers.get("if-none-match", "").split(",")]
+            if "*" in if_none_match or etag in [tag[2:] if tag.startswith("W/") else tag for tag in if_none_match]:
+                response = Response(status_code=304, headers=headers)
+            else:
+                if encoding:
+                    headers["Content-Encoding"] = encoding
+                response = Response(asset["variants"][encoding or "identity"], media_type=asset["media_type"], headers=headers)
+
+        await response(scope, receive, send)
+
+class ResponseCompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = chooseEncoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            body = message.get("body", b"")
+
+            # ストリーミングや圧縮済み・小さいレスポンスはそのまま流す
+            if (
+                message.get("more_body", False)
+                or "content-encoding" in headers
+                or not isCompressible(headers.get("content-type", ""))
+                or len(body) < self.minimum_size
+            ):
+                await send(start)
+                await send(message)
+                return
+
+            body = compressBody(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            await send({**start, "headers": headers.raw})
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+class UpstreamAdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        budget = RequestBudget()
+        token = request_budget.set(budget)
+        messages = asyncio.Queue()
+        response_complete = False
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.start" and budget.shed and message["status"] >= 500:
+                headers = [(k, v) for k, v in message.get("headers", []) if k.lower() != b"retry-after"]
+                headers.append((b"retry-after", str(RETRY_AFTER_SECONDS).encode()))
+                message = {**message, "status": 503, "headers": headers}
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        handler = asyncio.ensure_future(self.app(scope, messages.get, send_wrapper))
+
+        async def watch_disconnect():
+            while True:
+                message = await receive()
+                messages.put_nowait(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        # クライアントが切断したら残りの上流呼び出しを打ち切る
+                        budget.cancelled.set()
+                        handler.cancel()
+                    return
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not budget.cancelled.is_set():
+                handler.cancel()
+                raise
+        finally:
+            watcher.cancel()
+            request_budget.reset(token)
 
 app = FastAPI()
+app.add_middleware(UpstreamAdmissionMiddleware)
+app.add_middleware(ResponseCompressionMiddleware)
 invidious_api = InvidiousAPI() 
+playlist_index = PlaylistIndex()
+static_assets = StaticAssets(BASE_DIR / "static")
+edu_key_provider = EduKeyProvider()
 
 app.mount(
     "/static", 
-    StaticFiles(directory=str(BASE_DIR / "static")), 
+    static_assets, 
     name="static"
 )
 
+templates.env.globals["static_url"] = static_assets.url
+for template_name in templates.env.list_templates():
+    templates.env.get_template(template_name)
+
+
+@app.exception_handler(UpstreamSaturatedError)
+async def upstream_saturated_handler(request: Request, exc: UpstreamSaturatedError):
+    return Response(
+        content='{"detail": "Server is busy. Please retry later."}', 
+        media_type="application/json", 
+        status_code=503, 
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+@app.on_event("startup")
+async def start_background_tasks():
+    edu_key_provider.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await edu_key_provider.stop()
+
+@app.get("/api/metrics")
+async def get_metrics_route():
+    return {
+        "edu_key": edu_key_provider.stats(),
+        "upstream": {
+            kind: {"limit": limiter.limit, "active": limiter.active, "waiting": limiter.waiting}
+            for kind, limiter in upstream_limiters.items()
+        }
+    }
 
 @app.get("/api/edu")
 async def get_edu_key_route():
-    key = await run_in_threadpool(getEduKey)
+    key = await edu_key_provider.getKey()
     
     if key:
         return {"key": key}
     else:
-        return Response(content='{"error": "Failed to retrieve key from Kahoot API"}', media_type="application/json", status_code=500)
+        return Response(
+            content='{"error": "Failed to retrieve key from Kahoot API"}', 
+            media_type="application/json", 
+            status_code=503, 
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
 
 @app.get('/api/stream_high/{videoid}', response_class=HTMLResponse)
 async def embed_high_quality_video(request: Request, videoid: str, proxy: Union[str, None] = Cookie(None)):
     try:
-        stream_data = await run_in_threadpool(fetch_high_quality_streams, videoid)
+        stream_data = await runUpstream("stream", fetch_high_quality_streams, videoid)
         
     except APITimeoutError as e:
         return Response(f"Failed to retrieve high-quality stream URL: {e}", status_code=503)
@@ -498,7 +1240,7 @@ async def embed_high_quality_video(request: Request, videoid: str, proxy: Union[
 @app.get("/api/stream_360p_url/{videoid}")
 async def get_360p_stream_url_route(videoid: str):
     try:
-        url = await run_in_threadpool(get_360p_single_url, videoid)
+        url = await runUpstream("stream", get_360p_single_url, videoid)
         return {"stream_url": url}
     except APITimeoutError as e:
         return Response(content=f'{{"error": "Failed to get stream URL after multiple attempts: {str(e)}"}}', media_type="application/json", status_code=503)
@@ -518,7 +1260,7 @@ async def embed_edu_video(request: Request, videoid: str, proxy: Union[str, None
         
         return Response("Failed to retrieve stream URL from external service (HTTP Error).", status_code=503)
         
-    except (requests.exceptions.RequestException, ValueError, json.JSONDecodeError):
+    except (requests.exceptions.RequestException, ValueError, json.JSONDecodeError, APITimeoutError):
         return Response("Failed to retrieve stream URL from external service (Connection/Format Error).", status_code=503)
 
     return templates.TemplateResponse(
@@ -704,13 +1446,22 @@ async def channel(channelid: str, request: Request, proxy: Union[str, None] = Co
     })
 
 @app.get("/playlist", response_class=HTMLResponse)
-async def playlist(list: str, request: Request, page: Union[int, None] = 1, proxy: Union[str, None] = Cookie(None)):
-    playlist_data = await getPlaylistData(list, str(page))
+async def playlist(list: str, request: Request, page: Union[str, None] = "1", proxy: Union[str, None] = Cookie(None)):
+    if page != "all" and not (page.isascii() and page.isdigit()):
+        return Response("Invalid page parameter.", status_code=400)
+
+    playlist_data, page_count = await getPlaylistData(list, page)
+
+    last_page = min(page_count, PLAYLIST_MAX_PAGES) if page == "all" else int(page)
+    next_url = ""
+    if last_page < page_count:
+        next_url = f"/playlist?list={urllib.parse.quote(list)}&page={last_page + 1}"
+
     return templates.TemplateResponse("search.html", {
         "request": request, 
         "results": playlist_data, 
         "word": "", 
-        "next": f"/playlist?list={list}&page={page + 1}", 
+        "next": next_url, 
         "proxy": proxy
     })
 
@@ -725,17 +1476,22 @@ async def comments(request: Request, v: str):
 @app.get("/thumbnail")
 async def thumbnail(v: str):
     def sync_fetch_thumbnail(video_id: str):
-        res = requests.get(f"https://img.youtube.com/vi/{video_id}/0.jpg", timeout=(1.0, 3.0)) 
+        res = requestUpstream(requests.get, f"https://img.youtube.com/vi/{video_id}/0.jpg", timeout=(1.0, 3.0)) 
         res.raise_for_status()
         return res.content
 
     try:
-        content = await run_in_threadpool(sync_fetch_thumbnail, v)
+        content = await runUpstream("thumbnail", sync_fetch_thumbnail, v)
         return Response(content=content, media_type="image/jpeg")
-    except requests.exceptions.RequestException:
+    except UpstreamSaturatedError:
+        raise
+    except (requests.exceptions.RequestException, APITimeoutError):
         return Response(status_code=404) 
 
 @app.get("/suggest")
-def suggest(keyword: str):
-    res_text = requests.get("http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q=" + urllib.parse.quote(keyword), headers=getRandomUserAgent()).text
+async def suggest(keyword: str):
+    def sync_fetch_suggest():
+        return requestUpstream(requests.get, "http://www.google.com/complete/search?client=youtube&hl=ja&ds=yt&q=" + urllib.parse.quote(keyword), headers=getRandomUserAgent()).text
+
+    res_text = await runUpstream("suggest", sync_fetch_suggest)
     return [i[0] for i in json.loads(res_text[19:-1])[1]]